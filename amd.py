@@ -17,12 +17,20 @@ class static():
 
     fmt_string = "-- %-27s: %s\n"
 
+    # typecodes for columnar storage of microcode header fields, None is an interned object
+    columns = (("date", "I"), ("patch_id", "I"), ("patch_data_id", "H"), ("patch_data_len", "B"), ("init_flag", "B"), ("patch_data_checksum", "I"), ("nb_dev_id", "I"), ("sb_dev_id", "I"), ("processor_rev_id", "H"), ("nb_rev_id", "B"), ("sb_rev_id", "B"), ("bios_api_rev", "B"), ("unknown1", "B"), ("unknown2", "B"), ("unknown3", "B"), ("match_reg1", "I"), ("match_reg2", "I"), ("match_reg3", "I"), ("match_reg4", "I"), ("match_reg5", "I"), ("match_reg6", "I"), ("match_reg7", "I"), ("match_reg8", "I"), ("total_size", "I"), ("equiv_cpuid", None))
+
     def container_header(swap_endian):
         if swap_endian:
             return struct.Struct(">4sII")
         else:
             return struct.Struct("<4sII")
 
+    # find the next plausible container after a malformed one, using the magic string
+    def resync(data, offset, swap_endian):
+        offset = data.find(b"DMA\x00", offset + 1)
+        return offset if offset != -1 else len(data)
+
     def container_equiv(swap_endian):
         if swap_endian:
             return struct.Struct(">IIIHH")
@@ -153,7 +161,7 @@ class container():
             static.fmt_string % ("Errata Compare: ", microparse.static.hex8(entry[2])) + \
             static.fmt_string % ("Processor Revision ID: ", microparse.static.hex8(entry[3])) + \
             static.fmt_string % ("Unknown: ", microparse.static.hex8(entry[4])) + "\n"
-            #str(microparse.signature(entry[0]))
+            #str(microparse.signature.decode(entry[0]))
 
         if (len(self.preheaders) != len(self.microcodes)):
             raise Exception("Input preheaders and microcodes size mismatch!")
@@ -239,7 +247,7 @@ class microcode():
             self.processor_rev_id = header[8]
             if (self.equiv_cpuid):
                 for s in self.equiv_cpuid[self.processor_rev_id]:
-                    signature = microparse.signature(s)
+                    signature = microparse.signature.decode(s)
                     if (signature.family == 0xe and self.total_size > static.F14_MAX_SIZE) \
                     or (signature.family == 0xf and self.total_size > static.F15_MAX_SIZE) \
                     or ((signature.family != 0xe and signature.family != 0xf) and self.total_size > static.F1X_MAX_SIZE):
@@ -296,7 +304,7 @@ class microcode():
             for s in self.equiv_cpuid[self.processor_rev_id]:
                 output += \
                 microparse.signature.fmt_string % ("Processor Signature Entry", microparse.static.hex8(s)) + \
-                str(microparse.signature(s))
+                str(microparse.signature.decode(s))
 
         output += \
         microparse.static.fmt_string % ("Northbridge Revision ID", microparse.static.hex8(self.nb_rev_id)) + \
@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+import bisect
+import csv
+import os
+
+import amd
+import intel
+import microparse
+import via
+
+# Index of microcode by effective family, effective model, stepping and date, which are
+# sorted together so that prefix and range queries only visit matching entries.
+
+class static():
+    # bundled listings of publicly available microcode
+    LISTING_PATH = os.path.dirname(os.path.abspath(__file__))
+
+    # microcode dates are binary coded decimal, as 0xMMDDYYYY
+    def int2key(date):
+        hex_date = microparse.static.hex8(date)[2 : ]
+        if not hex_date.isdigit() or not 1 <= int(hex_date[0 : 2]) <= 12 or not 1 <= int(hex_date[2 : 4]) <= 31:
+            raise Exception("Unexpected date format!")
+
+        return int(hex_date[4 : 8] + hex_date[0 : 4])
+
+    def ymd2key(y, m, d):
+        return y * 10000 + m * 100 + d
+
+    # accepts the "m/d/yyyy" format of the listings and the "yyyy/mm/dd" format of the parser
+    def str2key(string):
+        values = [int(v) for v in string.split("/")]
+        if len(values) != 3:
+            raise Exception("Unexpected date format!")
+        elif values[0] > 12:
+            return static.ymd2key(values[0], values[1], values[2])
+        else:
+            return static.ymd2key(values[2], values[0], values[1])
+
+    def read_listing(name):
+        with open(os.path.join(static.LISTING_PATH, name), "r", newline = "") as f:
+            return list(csv.DictReader(f))
+
+    def match(condition, value):
+        if condition is None:
+            return True
+        elif isinstance(condition, tuple):
+            return (condition[0] is None or condition[0] <= value) and (condition[1] is None or value <= condition[1])
+        else:
+            return condition == value
+
+class index():
+    def __init__(self):
+        self.keys = []
+        self.records = []
+        self.pending = []
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    def add(self, signature, date, record):
+        s = microparse.signature.decode(signature)
+        self.pending.append(((s.effective_family, s.effective_model, s.stepping, date), record))
+
+    def add_microcode(self, m):
+        if isinstance(m, amd.container):
+            for microcode in m.microcodes:
+                # one microcode with an invalid date should not prevent indexing the rest of the container
+                try:
+                    self.add_microcode(microcode)
+                except Exception as e:
+                    microparse.static.tprint("Error: Cannot index " + microcode.filename() + ": " + str(e))
+        elif isinstance(m, amd.microcode):
+            # signatures are only known from the container equivalence table
+            if m.equiv_cpuid:
+                date = static.int2key(m.date)
+                for s in m.equiv_cpuid[m.processor_rev_id]:
+                    self.add(s, date, m)
+        elif isinstance(m, intel.microcode):
+            self.add(m.processor_signature, static.int2key(m.date), m)
+        elif isinstance(m, via.microcode):
+            self.add(m.signature, static.ymd2key(m.year, m.month, m.day), m)
+        else:
+            raise Exception("Unknown microcode type!")
+
+    def add_listing(self, vendor):
+        if vendor == "amd":
+            signatures = dict()
+            for row in static.read_listing("amd_mapping.csv"):
+                # some revisions have no known signature
+                if row["Processor Signature"]:
+                    signatures.setdefault(int(row["Processor Revision"], 16), []).append(int(row["Processor Signature"], 16))
+
+            for row in static.read_listing("amd.csv"):
+                for s in signatures.get(int(row["Processor Revision ID"], 16), []):
+                    self.add(s, static.str2key(row["Date"]), row)
+        elif vendor == "intel" or vendor == "via":
+            for row in static.read_listing(vendor + ".csv"):
+                self.add(int(row["Processor Signature"], 16), static.str2key(row["Date"]), row)
+        else:
+            raise Exception("Unknown microcode listing!")
+
+    # each of family, model and stepping is a value, an inclusive (low, high) range, or None for any.
+    # dates are inclusive, as yyyymmdd integers or strings accepted by static.str2key
+    def query(self, family = None, model = None, stepping = None, start = None, end = None):
+        self.sort()
+
+        if isinstance(start, str):
+            start = static.str2key(start)
+        if isinstance(end, str):
+            end = static.str2key(end)
+        conditions = (family, model, stepping, (start, end) if start is not None or end is not None else None)
+
+        # narrow the search with bisection on the leading exact values, followed by at most one range
+        prefix = ()
+        for i, condition in enumerate(conditions):
+            if not isinstance(condition, int):
+                break
+            prefix += (condition, )
+        else:
+            i = len(conditions)
+
+        if i < len(conditions) and isinstance(conditions[i], tuple):
+            low, high = conditions[i]
+            lower = prefix + (low, ) if low is not None else prefix
+            upper = prefix + (high + 1, ) if high is not None else (prefix[0 : -1] + (prefix[-1] + 1, ) if prefix else None)
+            remaining = conditions[i + 1 : ]
+            i += 1
+        else:
+            lower = prefix
+            upper = prefix[0 : -1] + (prefix[-1] + 1, ) if prefix else None
+            remaining = conditions[i : ]
+
+        first = bisect.bisect_left(self.keys, lower)
+        last = bisect.bisect_left(self.keys, upper) if upper is not None else len(self.keys)
+
+        output = []
+        for j in range(first, last):
+            key = self.keys[j]
+            if all(static.match(c, v) for c, v in zip(remaining, key[i : ])):
+                output.append(self.records[j])
+
+        return output
+
+    def sort(self):
+        if self.pending:
+            entries = sorted(list(zip(self.keys, self.records)) + self.pending, key = lambda e: e[0])
+            self.keys = [e[0] for e in entries]
+            self.records = [e[1] for e in entries]
+            self.pending = []
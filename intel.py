@@ -14,17 +14,57 @@ class static():
     # default data block size for old microcode revisions
     DEFAULT_DATA_SIZE = 2000
 
+    # typecodes for columnar storage of microcode header fields
+    columns = (("header_version", "I"), ("update_revision", "I"), ("date", "I"), ("processor_signature", "I"), ("checksum", "I"), ("loader_revision", "I"), ("processor_flags", "I"), ("data_size", "I"), ("total_size", "I"), ("unknown1", "i"), ("unknown2", "i"), ("unknown3", "i"), ("is_data_extended", "B"), ("is_extended", "B")) + \
+        (("data_unknown1", "I"), ("data_unknown2", "I"), ("data_unknown3", "I"), ("data_revision", "I"), ("data_unknown4", "I"), ("data_unknown5", "I"), ("data_date", "I"), ("data_length", "I"), ("data_unknown6", "I"), ("data_processor_signature", "I")) + \
+        tuple(("data_unknown" + str(i), "I") for i in range(7, 21))
+
     def header(swap_endian):
         if swap_endian:
             return struct.Struct("<IIIIIIIIIiii")
         else:
             return struct.Struct(">IIIIIIIIIiii")
 
+    # find the next plausible header after a malformed one, using the header version as a marker
+    def resync(data, offset, swap_endian):
+        marker = struct.Struct(static.header(swap_endian).format[0] + "I").pack(1)
+        offset = data.find(marker, offset + 1)
+
+        while offset != -1:
+            if static.is_valid(data, offset, swap_endian):
+                return offset
+            offset = data.find(marker, offset + 1)
+
+        return len(data)
+
+    # the header version is common in the payload, so candidates must also have a valid checksum
+    def is_valid(data, offset, swap_endian):
+        header = static.header(swap_endian)
+        if len(data) - offset < header.size:
+            return False
+
+        h = header.unpack_from(data, offset)
+        data_size = h[7] if h[7] != 0 else static.DEFAULT_DATA_SIZE
+        total_size = h[8] if h[8] != 0 else header.size + data_size
+        if h[0] != 1 or h[5] != 1 or data_size % 4 != 0 or total_size < header.size + data_size or total_size > len(data) - offset:
+            return False
+
+        # same as calculate_checksum, with the payload in either the header or the data byte order
+        checksum = sum(h) - h[7] - h[8] + data_size + total_size
+        for order in (header.format[0], microparse.static.data(swap_endian).format[0]):
+            words = struct.unpack_from(order + str(data_size // 4) + "I", data, offset + header.size)
+            if (checksum + sum(words)) & 0xFFFFFFFF == 0:
+                return True
+
+        return False
+
+    # precompiled, since the data header is decoded for most microcode
+    data_headers = {True : struct.Struct("<IIIIIIIIIIIIIIIIIIIIIIII"), False : struct.Struct(">IIIIIIIIIIIIIIIIIIIIIIII")}
+    # offset of the update revision in the data header
+    DATA_REVISION_OFFSET = 12
+
     def data_header(swap_endian):
-        if swap_endian:
-            return struct.Struct("<IIIIIIIIIIIIIIIIIIIIIIII")
-        else:
-            return struct.Struct(">IIIIIIIIIIIIIIIIIIIIIIII")
+        return static.data_headers[swap_endian]
 
     def extended_count(swap_endian):
         if swap_endian:
@@ -40,9 +80,9 @@ class microcode():
         self.parse_data(data[static.header(self.is_swap_endian).size : static.header(self.is_swap_endian).size + self.data_size])
 
         self.is_data_extended = False
-        if self.data.count(0) > 8: # weak heuristic for additional metadata in data block
+        if self.detect_data_header(data):
             self.is_data_extended = True
-            self.parse_data_header()
+            self.parse_data_header(data[static.header(self.is_swap_endian).size : static.header(self.is_swap_endian).size + static.data_header(self.is_swap_endian).size])
 
         self.is_extended = False
         if self.total_size - (static.header(self.is_swap_endian).size + self.data_size) > 0: # metadata has extended section
@@ -120,16 +160,18 @@ class microcode():
         else:
             raise Exception("Input microcode data size mismatch!")
 
-    def parse_data_header(self):
-        if self.is_data_extended and len(self.data) > static.data_header(self.is_swap_endian).size:
-            try:
-                # bit of a hack, need to repack the data back into a list
-                header = bytearray()
-                for i in range(static.data_header(self.is_swap_endian).size // 4):
-                    header += microparse.static.data(self.is_swap_endian).pack(self.data[i])
-                # now unpack
-                data_header = static.data_header(self.is_swap_endian).unpack(header[0 : static.data_header(self.is_swap_endian).size])
+    def detect_data_header(self, data):
+        # metadata in data block repeats the update revision at a fixed position
+        if self.update_revision != 0 and self.data_size >= static.data_header(self.is_swap_endian).size:
+            offset = static.header(self.is_swap_endian).size + static.DATA_REVISION_OFFSET
+            return data[offset : offset + 4] == data[4 : 8]
+
+        return False
 
+    def parse_data_header(self, data):
+        if self.is_data_extended and len(data) == static.data_header(self.is_swap_endian).size:
+            try:
+                data_header = static.data_header(self.is_swap_endian).unpack(data)
             except struct.error:
                 raise Exception("Cannot unpack microcode data header!")
 
@@ -228,7 +270,7 @@ class microcode():
         microparse.static.fmt_string % ("Update Revision", microparse.static.hex8(self.update_revision)) + \
         microparse.static.fmt_string % ("Date", microparse.static.int2date(self.date)) + \
         microparse.static.fmt_string % ("Processor Signature", microparse.static.hex8(self.processor_signature)) + \
-        str(microparse.signature(self.processor_signature)) + \
+        str(microparse.signature.decode(self.processor_signature)) + \
         microparse.static.fmt_string % ("Checksum", microparse.static.hex8(self.checksum) + checksum1) + \
         microparse.static.fmt_string % ("Loader Revision", microparse.static.hex8(self.loader_revision)) + \
         microparse.static.fmt_string % ("Processor Flags", microparse.static.hex8(self.processor_flags)) + \
@@ -250,7 +292,7 @@ class microcode():
             microparse.static.fmt_string % ("Data Length", microparse.static.hex8(self.data_length)) + \
             microparse.static.fmt_string % ("Data Unknown 6", microparse.static.hex8(self.data_unknown6)) + \
             microparse.static.fmt_string % ("Data Processor Signature", microparse.static.hex8(self.data_processor_signature)) + \
-            str(microparse.signature(self.data_processor_signature)) + \
+            str(microparse.signature.decode(self.data_processor_signature)) + \
             microparse.static.fmt_string % ("Data Unknown 7", microparse.static.hex8(self.data_unknown7)) + \
             microparse.static.fmt_string % ("Data Unknown 8", microparse.static.hex8(self.data_unknown8)) + \
             microparse.static.fmt_string % ("Data Unknown 9", microparse.static.hex8(self.data_unknown9)) + \
@@ -2,17 +2,30 @@
 
 import argparse
 import datetime
+import functools
+import hashlib
 import os
 import re
+import sys
 import binascii
 import struct
+import concurrent.futures
+import io
+import gzip
+import bz2
+import lzma
+import tarfile
+import zipfile
+import zlib
 
 import amd
 import intel
+import toc
 import via
 
 # Used to parse processor signature
 class signature():
+    __slots__ = ("stepping", "model", "family", "type", "unknown1", "extended_model", "extended_family", "unknown2", "string")
     fmt_string = "-- %-27s: %s\n"
 
     def __init__(self, signature):
@@ -39,22 +52,65 @@ class signature():
             signature = signature >> 8
 
             self.unknown2 = signature & 0xF
+            self.string = None
         else:
             raise Exception("Invalid processor signature!")
 
+    # extended fields only apply to some families
+    @property
+    def effective_family(self):
+        return self.family + self.extended_family if self.family == 0xF else self.family
+
+    @property
+    def effective_model(self):
+        return (self.extended_model << 4) + self.model if self.family == 0x6 or self.family == 0xF else self.model
+
+    # the same signatures repeat across the corpus, so decoded objects are shared and must not be modified
+    @functools.lru_cache(maxsize = 4096)
+    def decode(value):
+        return signature(value)
+
+    def decode_all(values):
+        decoded = dict()
+
+        for v in values:
+            if v not in decoded:
+                decoded[v] = signature.decode(v)
+
+        return [decoded[v] for v in values]
+
     def __str__(self):
-        return \
-        signature.fmt_string % ("Stepping", static.hex8(self.stepping)) + \
-        signature.fmt_string % ("Model", static.hex8(self.model)) + \
-        signature.fmt_string % ("Family", static.hex8(self.family)) + \
-        signature.fmt_string % ("Type", static.hex8(self.type)) + \
-        signature.fmt_string % ("Unknown 1", static.hex8(self.unknown1)) + \
-        signature.fmt_string % ("Extended Model", static.hex8(self.extended_model)) + \
-        signature.fmt_string % ("Extended Family", static.hex8(self.extended_family)) + \
-        signature.fmt_string % ("Unknown 2", static.hex8(self.unknown2))
+        if self.string is None:
+            self.string = \
+            signature.fmt_string % ("Stepping", static.hex8(self.stepping)) + \
+            signature.fmt_string % ("Model", static.hex8(self.model)) + \
+            signature.fmt_string % ("Family", static.hex8(self.family)) + \
+            signature.fmt_string % ("Type", static.hex8(self.type)) + \
+            signature.fmt_string % ("Unknown 1", static.hex8(self.unknown1)) + \
+            signature.fmt_string % ("Extended Model", static.hex8(self.extended_model)) + \
+            signature.fmt_string % ("Extended Family", static.hex8(self.extended_family)) + \
+            signature.fmt_string % ("Unknown 2", static.hex8(self.unknown2))
+
+        return self.string
+
+# Used to record malformed microcode in recovery mode
+class error():
+    def __init__(self, path, offset, reason):
+        self.path = path
+        self.offset = offset
+        self.reason = reason
+
+    def csv(self):
+        return self.path + "," + static.hex8(self.offset) + "," + self.reason + "\n"
+
+    def __str__(self):
+        return self.path + " @ " + static.hex8(self.offset) + ": " + self.reason
 
 class static():
     fmt_string = "%-30s: %s\n"
+    # coreboot style, four words per line
+    hex_string = "0x%08x, 0x%08x, 0x%08x, 0x%08x,\n"
+    HEX_BATCH_LINES = 1024
 
     def data(swap_endian):
         if not swap_endian:
@@ -72,26 +128,220 @@ class static():
     def hex8(num):
         return "0x%08x" % num
 
+    manifest_entry = re.compile("^([0-9a-fA-F]{64}) [ *](.+)$")
+
+    archive_extensions = (".zip", ".tar", ".tgz", ".txz", ".tbz2", ".gz", ".xz", ".bz2")
+
+    def is_microcode(path, is_member = False):
+        name = os.path.basename(path)
+        # archive members without extension are used by linux-firmware, e.g. intel-ucode/06-55-04
+        if is_member and "." not in name:
+            return True
+        return name.endswith((".dat", ".bin", ".txt", ".pdb", ".PDB", ".cfg", ".h", ".c"))
+
+    def vendor(name):
+        return {"amd" : amd, "intel" : intel, "via" : via}[name]
+
+    def extension():
+        return ".h" if result.export else ".bin"
+
+    def sha256(data):
+        return hashlib.sha256(data).hexdigest()
+
     def tprint(string):
         print(str(datetime.datetime.now()) + ": " + string)
 
+# Thread pool with a bounded queue, so that queued microcode does not accumulate in memory
+class pool():
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        self.pending = set()
+
+    def submit(self, function, *args):
+        if len(self.pending) >= 4 * self.workers:
+            done, self.pending = concurrent.futures.wait(self.pending, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        future = self.executor.submit(function, *args)
+        self.pending.add(future)
+        return future
+
+    def close(self):
+        try:
+            for future in concurrent.futures.as_completed(self.pending):
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+    # stops after an error elsewhere, without raising errors from queued work
+    def abort(self):
+        self.executor.shutdown(cancel_futures = True)
+
+# Writes segmented microcode from a thread pool, through temporary files that are atomically renamed
+class writer():
+    def __init__(self, path, workers, fsync, text_order = None):
+        self.path = path
+        self.fsync = fsync
+        # byte order of words when writing hex text instead of binary
+        self.text_order = text_order
+        self.written = 0
+        self.skipped = 0
+
+        os.makedirs(self.path, exist_ok = True)
+        self.existing = set(os.listdir(self.path))
+
+        self.pool = pool(workers)
+
+    def write(self, name, raw):
+        if name in self.existing:
+            self.skipped += 1
+            return
+        self.existing.add(name)
+
+        self.pool.submit(self.dump, name, raw)
+        self.written += 1
+
+    def dump(self, name, raw):
+        filename = os.path.join(self.path, name)
+        temporary = os.path.join(self.path, "." + name + "." + str(os.getpid()) + ".tmp")
+
+        try:
+            with open(temporary, "wb") as f:
+                if self.text_order:
+                    bin2ascii(f, raw, self.text_order)
+                else:
+                    f.write(raw)
+
+                if self.fsync != "none":
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            os.replace(temporary, filename)
+        except BaseException:
+            # do not leave partial files behind in the output directory
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+
+    def close(self):
+        self.pool.close()
+
+        if self.fsync == "all":
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        static.tprint("Wrote " + str(self.written) + " file(s) to " + self.path + ", skipped " + str(self.skipped) + " existing")
+
+    def abort(self):
+        self.pool.abort()
+
+# Hashes segmented microcode from a thread pool, to generate or verify a SHA-256 manifest
+class manifest():
+    def __init__(self, path, workers, verify, text_order = None):
+        self.path = path
+        self.verify = verify
+        # byte order of words when hashing hex text instead of binary
+        self.text_order = text_order
+
+        # same format as sha256sum, so the manifest can also be checked against segmented microcode
+        self.known = dict()
+        if self.verify:
+            with open(self.path, "r") as f:
+                for number, line in enumerate(f, 1):
+                    line = line.rstrip("\n")
+                    if not line.strip():
+                        continue
+
+                    # text mode entries are separated by two spaces, binary mode entries by " *"
+                    entry = static.manifest_entry.match(line)
+                    if not entry:
+                        raise Exception("Malformed manifest line " + str(number) + " in " + self.path + ": " + line)
+                    self.known[entry.group(2)] = entry.group(1).lower()
+
+        self.pool = pool(workers)
+        # completed futures only hold the hash, not the microcode
+        self.pending = dict()
+
+    def add(self, name, raw):
+        if name not in self.pending:
+            self.pending[name] = self.pool.submit(self.hash, raw)
+
+    def hash(self, raw):
+        if self.text_order:
+            f = io.BytesIO()
+            bin2ascii(f, raw, self.text_order)
+            raw = f.getvalue()
+
+        return static.sha256(raw)
+
+    def close(self):
+        self.pool.close()
+
+        hashes = dict()
+        for name, future in self.pending.items():
+            hashes[name] = future.result()
+
+        if not self.verify:
+            with open(self.path, "w") as f:
+                for name in sorted(hashes):
+                    f.write(hashes[name] + "  " + name + "\n")
+
+            static.tprint("Wrote " + str(len(hashes)) + " hash(es) to " + self.path)
+            return True
+
+        mismatched = [name for name in sorted(hashes) if name in self.known and self.known[name] != hashes[name]]
+        unknown = [name for name in sorted(hashes) if name not in self.known]
+        missing = [name for name in sorted(self.known) if name not in hashes]
+
+        for name in mismatched:
+            static.tprint("Hash mismatch: " + name)
+        for name in unknown:
+            static.tprint("Unknown microcode: " + name)
+
+        static.tprint("Verified " + str(len(hashes) - len(mismatched) - len(unknown)) + " hash(es) against " + self.path + ", " + str(len(mismatched)) + " mismatched, " + str(len(unknown)) + " unknown, " + str(len(missing)) + " not found")
+        return not mismatched and not unknown
+
+    def abort(self):
+        self.pool.abort()
+
 def ascii2bin(data):
-    code = b""
-    values = re.sub(b"[ \t\r]", b"", data) # remove spaces, tabs, and newlines (windows)
-    values = re.split(b"[,\n]", values) # split on newlines (linux) and commas
+    return b"".join(binascii.unhexlify(value) for start, end, value in ascii_fields(data))
+
+# Hex values of ASCII microcode, with the (start, end) span of each field in the input
+def ascii_fields(data):
+    for field in re.finditer(b"[^,\n]+", data): # split on newlines (linux) and commas
+        value = field.group().translate(None, b" \t\r") # remove spaces, tabs, and newlines (windows)
+
+        if value.startswith(b"0x"):
+            yield (field.start(), field.end(), value[2 : ])
 
-    for v in values:
-        if v.startswith(b"0x"):
-            code += binascii.unhexlify(bytes(v[2 : ]))
+# Inverse of ascii2bin, formats a batch of lines at a time and streams them to the file
+def bin2ascii(f, data, order):
+    if len(data) % 4 != 0:
+        raise Exception("Input microcode size is not a multiple of the word size!")
+
+    batch = struct.Struct(order + str(static.HEX_BATCH_LINES * 4) + "I")
+    batch_string = static.hex_string * static.HEX_BATCH_LINES
+
+    offset = 0
+    while len(data) - offset >= batch.size:
+        f.write((batch_string % batch.unpack_from(data, offset)).encode())
+        offset += batch.size
 
-    return code
+    words = struct.unpack_from(order + str((len(data) - offset) // 4) + "I", data, offset)
+    lines = len(words) // 4
+    output = static.hex_string * lines % words[0 : lines * 4]
+    if len(words) % 4:
+        output += ", ".join("0x%08x" % w for w in words[lines * 4 : ]) + ",\n"
+    f.write(output.encode())
 
-def detect_ascii(path):
-    with open(path, "rb") as f:
-        for block in f:
-            if b'\0' in block: # check for null
-                return False
-    return True
+def detect_ascii(data):
+    return b"\0" not in data # check for null
 
 def open_path(path):
     if os.path.isdir(path):
@@ -103,96 +353,293 @@ def open_path(path):
 
             else:
                 raise Exception("Cannot open directory without recursion")
+    elif path.endswith(toc.static.EXTENSION):
+        # table of contents sidecars written by -s
+        pass
+    elif path.lower().endswith(static.archive_extensions):
+        with open(path, "rb") as f:
+            open_archive(path, f)
     else:
-        data = b""
         static.tprint("Parsing " + path)
 
-        if path.endswith((".dat", ".bin", ".txt", ".pdb", ".PDB", ".cfg", ".h", ".c")):
+        if not static.is_microcode(path):
+            static.tprint("Error: File extension not recognized")
+        elif result.signature is not None:
+            with open(path, "rb") as f:
+                select(path, f)
+        else:
             with open(path, "rb") as f:
-                data = f.read()
+                parse_file(path, f.read())
+
+# Members are read directly from the archive stream, paths are reported as archive/member
+def open_archive(path, f, is_member = False):
+    static.tprint("Opening " + path)
+    name = path.lower()
+
+    try:
+        if name.endswith(".zip"):
+            # zip files need random access, which members of other archives, e.g. tar streams, do not provide
+            if is_member:
+                f = io.BytesIO(f.read())
+
+            with zipfile.ZipFile(f) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        with archive.open(info) as member:
+                            open_member(path + "/" + info.filename, member)
+        elif name.endswith((".tar", ".tgz", ".txz", ".tbz2", ".tar.gz", ".tar.xz", ".tar.bz2")):
+            with tarfile.open(fileobj = f, mode = "r|*") as archive:
+                for info in archive:
+                    if info.isfile():
+                        open_member(path + "/" + info.name, archive.extractfile(info))
+        else:
+            # single compressed file, the member is named after the archive
+            member = os.path.basename(path).rsplit(".", 1)[0]
 
-            if detect_ascii(path):
-                data = ascii2bin(data)
+            if name.endswith(".gz"):
+                open_member(path + "/" + member, gzip.GzipFile(fileobj = f))
+            elif name.endswith(".xz"):
+                open_member(path + "/" + member, lzma.LZMAFile(f))
+            else:
+                open_member(path + "/" + member, bz2.BZ2File(f))
+    except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile, lzma.LZMAError, zlib.error) as e:
+        if not result.recover:
+            raise
+        record_error(path, 0, "Cannot read archive: " + str(e))
+
+def open_member(path, f):
+    try:
+        read_member(path, f)
+    except Exception as e:
+        if not result.recover:
+            raise
+        record_error(path, 0, "Cannot read archive member: " + str(e))
+
+def read_member(path, f):
+    if path.lower().endswith(static.archive_extensions):
+        open_archive(path, f, True)
+    else:
+        static.tprint("Parsing " + path)
 
-            parse(data)
-        else:
+        if not static.is_microcode(path, True):
             static.tprint("Error: File extension not recognized")
+        elif result.signature is not None:
+            # archive members have no sidecar, so the table of contents is only kept in memory
+            data = f.read()
+            select(path, io.BytesIO(data), data)
+        else:
+            parse_file(path, f.read())
 
-def parse(data):
-    offset = 0
+def parse_file(path, data):
+    if detect_ascii(data):
+        try:
+            data = ascii2bin(data)
+        except binascii.Error as e:
+            if not result.recover:
+                raise
+            record_error(path, 0, "Cannot convert ASCII microcode: " + str(e))
+            return
 
-    while offset < len(data):
-        if result.type == "amd":
-            if (result.amd_individual):
-                m = amd.microcode(data[offset : ], dict(), 0, result.swap_endian)
-            else:
-                m = amd.container(data[offset : ], result.swap_endian)
-        elif result.type == "intel":
-            m = intel.microcode(data[offset: ], result.swap_endian)
-        elif result.type == "via":
-            m = via.microcode(data[offset: ], result.swap_endian)
-        else:
-            raise Exception("Microcode format not specified")
+    parse(data, path)
 
-        if result.verbose:
-            print(m)
+def parse(data, path):
+    if result.type not in ("amd", "intel", "via"):
+        raise Exception("Microcode format not specified")
 
-        if result.report:
-            report(m)
+    offset = 0
+    # start and reason of the current malformed span, reported once the next microcode is found
+    corrupt = None
 
-        if result.output:
-            output(m)
+    while offset < len(data):
+        try:
+            if result.type == "amd":
+                if (result.amd_individual):
+                    m = amd.microcode(data[offset : ], dict(), 0, result.swap_endian)
+                else:
+                    m = amd.container(data[offset : ], result.swap_endian)
+            elif result.type == "intel":
+                m = intel.microcode(data[offset: ], result.swap_endian)
+            elif result.type == "via":
+                m = via.microcode(data[offset: ], result.swap_endian)
+
+            if m.size() <= 0:
+                raise Exception("Unexpected microcode size!")
+        except Exception as e:
+            if not result.recover:
+                raise
+
+            if corrupt is None:
+                corrupt = (offset, str(e))
+            offset = resync(data, offset)
+            continue
+
+        if corrupt is not None:
+            record_corrupt(path, corrupt, offset)
+            corrupt = None
+
+        process(m, path)
 
         offset += m.size()
 
-def output(m):
-    if result.type != "amd" or result.amd_individual:
-        filename = result.output + "/" + m.filename() + ".bin"
-
-        if not os.path.exists(result.output):
-            os.makedirs(result.output)
+    if corrupt is not None:
+        record_corrupt(path, corrupt, len(data))
 
-        if not os.path.exists(filename):
-            with open(filename, "wb") as f:
-                static.tprint("Writing " + f.name)
-                f.write(m.raw)
+# Only parses microcode matching the processor signature, using the table of contents
+def select(path, f, data = None):
+    try:
+        if data is None:
+            t = toc.open_toc(path, static.vendor(result.type), result.swap_endian)
         else:
-            static.tprint("File " + filename + " already exists!")
+            t = toc.toc(static.vendor(result.type), result.swap_endian)
+            t.build(data)
+    except Exception as e:
+        if not result.recover:
+            raise
+        record_error(path, 0, "Cannot build table of contents: " + str(e))
+        return
+
+    for entry in t.lookup(result.signature):
+        try:
+            m = t.extract(f, entry)
+        except Exception as e:
+            if not result.recover:
+                raise
+            record_error(path, entry[0], str(e))
+            continue
+
+        process(m, path)
+
+def process(m, path):
+    if result.verbose:
+        print(m)
+
+    if result.report:
+        report(m, path)
+
+    if result.output:
+        output(m)
+
+    if digests:
+        digest(m)
+
+def resync(data, offset):
+    if result.type == "amd":
+        if result.amd_individual:
+            # no magic string to search for, so give up on the rest of the input
+            return len(data)
+        return amd.static.resync(data, offset, result.swap_endian)
+    elif result.type == "intel":
+        return intel.static.resync(data, offset, result.swap_endian)
     else:
-        for microcode in m.microcodes:
-            filename = result.output + "/" + microcode.filename() + ".bin"
+        return via.static.resync(data, offset, result.swap_endian)
 
-            if not os.path.exists(result.output):
-                os.makedirs(result.output)
+def record_corrupt(path, corrupt, end):
+    record_error(path, corrupt[0], corrupt[1] + " (skipped " + str(end - corrupt[0]) + " bytes)")
 
-            if not os.path.exists(filename):
-                with open(filename, "wb") as f:
-                    static.tprint("Writing " + f.name)
-                    f.write(microcode.raw)
-            else:
-                static.tprint("File " + filename + " already exists!")
+def record_error(path, offset, reason):
+    errors.append(error(path, offset, reason))
+    static.tprint("Error: " + str(errors[-1]))
 
-def report(m):
+def split(m):
+    if isinstance(m, amd.container):
+        return m.microcodes
+    else:
+        return [m]
+
+def output(m):
+    for microcode in split(m):
+        destination.write(microcode.filename() + static.extension(), microcode.raw)
+
+# hashes the same names and contents that output writes, so manifests can be checked in the output directory
+def digest(m):
+    for microcode in split(m):
+        digests.add(microcode.filename() + static.extension(), microcode.raw)
+
+def report(m, path):
     with open("report.csv", "a") as f:
-        f.write(m.csv())
+        for line in m.csv().splitlines(True):
+            f.write(path + "," + line)
     static.tprint("Updating report file")
 
 def main():
-    global result
+    global result, errors, destination, digests
 
     parser = argparse.ArgumentParser(description = "Microparse: AMD/Intel/VIA CPU microcode update parser")
     parser.add_argument("-c", action = "store_true", dest = "amd_individual", default = False, help = "amd microcode is not in container (rare)")
     parser.add_argument("-e", action = "store_true", dest = "swap_endian", default = False, help = "swap parsing endianess")
+    parser.add_argument("-f", action = "store", dest = "fsync", choices = ["none", "file", "all"], default = "none", help = "sync segmented microcode to disk: not at all, each file, or each file and the output directory")
+    parser.add_argument("-j", action = "store", dest = "workers", type = int, default = 8, help = "number of threads writing or hashing segmented microcode")
+    parser.add_argument("-k", action = "store_true", dest = "recover", default = False, help = "record malformed microcode and resume at the next header")
+    parser.add_argument("-m", action = "store", dest = "manifest", help = "write SHA-256 manifest of segmented microcode")
+    parser.add_argument("-M", action = "store", dest = "verify_manifest", help = "verify segmented microcode against SHA-256 manifest")
     parser.add_argument("-o", action = "store", dest = "output", help = "output directory for segmented microcode")
     parser.add_argument("-p", action = "store_true", dest = "report", default = False, help = "generate CSV report of all parsed microcode")
     parser.add_argument("-r", action = "store_true", dest = "recursive", default = False, help = "recurse into directory")
+    parser.add_argument("-s", action = "store", dest = "signature", type = lambda x: int(x, 0), help = "only process microcode for processor signature, using a table of contents stored next to each input")
     parser.add_argument("-t", action = "store", dest = "type", choices = ["amd", "intel", "via"], help = "specify input format as amd, intel, or via microcode")
     parser.add_argument("-v", action = "store_true", dest = "verbose", default = False, help = "verbose output")
+    parser.add_argument("-x", action = "store_true", dest = "export", default = False, help = "write segmented microcode as hex text (coreboot C header) instead of binary")
     parser.add_argument("target", action = "store", help = "input file or folder")
 
     result = parser.parse_args()
+    errors = []
+
+    if result.workers < 1:
+        parser.error("argument -j: must be at least 1")
+
+    if result.manifest and result.verify_manifest:
+        raise Exception("Cannot write and verify manifest at the same time")
 
-    open_path(result.target)
+    if result.signature is not None and result.type is None:
+        raise Exception("Microcode format not specified")
+    elif result.signature is not None and result.type == "amd" and result.amd_individual:
+        raise Exception("Cannot select individual AMD microcode by processor signature")
+
+    if result.export and result.type is None:
+        raise Exception("Microcode format not specified")
+    elif result.export and not result.output:
+        raise Exception("Cannot export hex text without output directory")
+
+    # words are written in the byte order that the header was parsed with
+    text_order = static.vendor(result.type).static.header(result.swap_endian).format[0] if result.export else None
+
+    if result.manifest or result.verify_manifest:
+        try:
+            digests = manifest(result.manifest or result.verify_manifest, result.workers, bool(result.verify_manifest), text_order)
+        except Exception as e:
+            static.tprint("Error: " + str(e))
+            sys.exit(1)
+    else:
+        digests = None
+
+    if result.output:
+        destination = writer(result.output, result.workers, result.fsync, text_order)
+    else:
+        destination = None
+
+    try:
+        open_path(result.target)
+    except BaseException:
+        # errors from queued work must not mask the original exception
+        if destination:
+            destination.abort()
+        if digests:
+            digests.abort()
+        raise
+
+    if destination:
+        destination.close()
+
+    verified = digests.close() if digests else True
+
+    if errors:
+        with open("errors.csv", "w") as f:
+            for e in errors:
+                f.write(e.csv())
+        static.tprint("Encountered " + str(len(errors)) + " malformed microcode, see errors.csv")
+
+    if not verified:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+
+import array
+import struct
+
+import amd
+import microparse
+
+# Columnar record store for large corpora: header fields are held in typed arrays,
+# and the payload stays in the source buffers, referenced by offset.
+
+class static():
+    # bookkeeping columns shared by all vendors
+    columns = (("is_swap_endian", "B"), ("_buffer", "I"), ("_offset", "Q"), ("_length", "I"), ("_data_count", "I"))
+
+class store():
+    def __init__(self, vendor):
+        self.vendor = vendor
+        self.view = type("row", (row, vendor.microcode), {})
+
+        self.buffers = []
+        self.buffer_index = dict()
+
+        self.columns = dict()
+        self.interned = dict()
+        for name, typecode in vendor.static.columns + static.columns:
+            if typecode is None:
+                # objects are stored once, and referenced by index
+                self.columns[name] = array.array("I")
+                self.interned[name] = ([], dict())
+            else:
+                self.columns[name] = array.array(typecode)
+
+    def __len__(self):
+        return len(self.columns["_offset"])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Record index out of range!")
+
+        return self.view(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.view(self, i)
+
+    def column(self, name):
+        if name in self.interned:
+            values = self.interned[name][0]
+            return [values[i] for i in self.columns[name]]
+
+        return self.columns[name]
+
+    def append(self, m, buffer, offset = 0):
+        # amd containers are split into individual microcode
+        if isinstance(m, amd.container):
+            offset += amd.static.container_header(m.is_swap_endian).size + m.equiv_size
+
+            for i in range(len(m.microcodes)):
+                offset += amd.static.container_preheader(m.is_swap_endian).size
+                self.append(m.microcodes[i], buffer, offset)
+                offset += m.preheaders[i][1]
+
+            return
+
+        if not isinstance(m, self.vendor.microcode):
+            raise Exception("Input microcode type mismatch!")
+
+        if id(buffer) not in self.buffer_index:
+            self.buffer_index[id(buffer)] = len(self.buffers)
+            self.buffers.append(buffer)
+
+        for name, column in self.columns.items():
+            if name == "_buffer":
+                value = self.buffer_index[id(buffer)]
+            elif name == "_offset":
+                value = offset
+            elif name == "_length":
+                value = len(m.raw)
+            elif name == "_data_count":
+                value = len(m.data)
+            else:
+                # fields that were not parsed, e.g. intel data header, default to zero
+                value = getattr(m, name, 0)
+
+            if name in self.interned:
+                value = self.intern(name, value)
+
+            column.append(value)
+
+    def intern(self, name, value):
+        values, lookup = self.interned[name]
+        # mappings such as the amd equivalence table are shared by reference
+        key = id(value) if isinstance(value, dict) else value
+
+        if key not in lookup:
+            lookup[key] = len(values)
+            values.append(value)
+
+        return lookup[key]
+
+# Lightweight view of a single record, which reuses the methods of the vendor microcode class
+class row():
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getattr__(self, name):
+        store = self.__dict__.get("store")
+
+        if store is None or name not in store.columns:
+            raise AttributeError(name)
+
+        value = store.columns[name][self.index]
+        if name in store.interned:
+            value = store.interned[name][0][value]
+
+        return value
+
+    @property
+    def raw(self):
+        offset = self._offset
+        return self.store.buffers[self._buffer][offset : offset + self._length]
+
+    @property
+    def data(self):
+        if not self._data_count:
+            return ()
+
+        fmt = microparse.static.data(self.is_swap_endian).format[0] + str(self._data_count) + "I"
+        return struct.unpack_from(fmt, self.store.buffers[self._buffer], self._offset + self.vendor.static.header(self.is_swap_endian).size)
+
+    @property
+    def vendor(self):
+        return self.store.vendor
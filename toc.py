@@ -0,0 +1,201 @@
+#! /usr/bin/env python3
+
+import bisect
+import os
+import struct
+
+import amd
+import intel
+import microparse
+import via
+
+# Table of contents for concatenated microcode, built with a header-only pass and stored next
+# to the input, so that later lookups can seek straight to the microcode that is needed.
+
+class static():
+    EXTENSION = ".toc"
+
+    # entries are (offset, size, processor signature, processor flags, update revision, checksum)
+    def scan(data, vendor, swap_endian):
+        if vendor is intel:
+            return static.scan_intel(data, swap_endian)
+        elif vendor is via:
+            return static.scan_via(data, swap_endian)
+        elif vendor is amd:
+            return static.scan_amd(data, swap_endian)
+        else:
+            raise Exception("Unknown microcode type!")
+
+    def scan_intel(data, swap_endian):
+        header = intel.static.header(swap_endian)
+        offset = 0
+
+        while offset < len(data):
+            try:
+                h = header.unpack_from(data, offset)
+            except struct.error:
+                raise Exception("Cannot unpack microcode header!")
+
+            if h[0] != 1:
+                raise Exception("Unexpected microcode header version!")
+            data_size = h[7] if h[7] != 0 else intel.static.DEFAULT_DATA_SIZE
+            total_size = h[8] if h[8] != 0 else header.size + data_size
+
+            yield (offset, total_size, h[3], h[6], h[1], h[4])
+            offset += total_size
+
+    def scan_via(data, swap_endian):
+        header = via.static.header(swap_endian)
+        offset = 0
+
+        while offset < len(data):
+            try:
+                h = header.unpack_from(data, offset)
+            except struct.error:
+                raise Exception("Cannot unpack microcode header!")
+
+            if h[0] != b"SARR":
+                raise Exception("Input microcode magic string mismatch!")
+            if h[10] == 0:
+                raise Exception("Unexpected microcode size!")
+
+            yield (offset, h[10], h[5], 0, h[1], h[6])
+            offset += h[10]
+
+    def scan_amd(data, swap_endian):
+        container_header = amd.static.container_header(swap_endian)
+        container_equiv = amd.static.container_equiv(swap_endian)
+        container_preheader = amd.static.container_preheader(swap_endian)
+        header = amd.static.header(swap_endian)
+
+        try:
+            h = container_header.unpack_from(data, 0)
+        except struct.error:
+            raise Exception("Cannot unpack microcode container header!")
+
+        if h[0] != b"DMA\x00":
+            raise Exception("Input microcode container magic string mismatch!")
+
+        equiv_cpuid = dict()
+        for offset in range(container_header.size, container_header.size + h[2], container_equiv.size):
+            try:
+                equiv = container_equiv.unpack_from(data, offset)
+            except struct.error:
+                raise Exception("Cannot unpack CPU equivalence table!")
+
+            if equiv[0] != 0:
+                equiv_cpuid.setdefault(equiv[3], []).append(equiv[0])
+
+        offset = container_header.size + h[2]
+        while offset < len(data):
+            try:
+                preheader = container_preheader.unpack_from(data, offset)
+                h = header.unpack_from(data, offset + container_preheader.size)
+            except struct.error:
+                raise Exception("Cannot unpack microcode header!")
+
+            if preheader[0] != 1:
+                raise Exception("Unexpected microcode preheader type!")
+
+            # one entry per processor signature of the microcode
+            for s in equiv_cpuid.get(h[8], []):
+                yield (offset + container_preheader.size, preheader[1], s, 0, h[1], h[5])
+            offset += container_preheader.size + preheader[1]
+
+class toc():
+    def __init__(self, vendor, swap_endian):
+        self.vendor = vendor
+        self.is_swap_endian = swap_endian
+        self.is_ascii = False
+        self.entries = []
+        self.signatures = dict()
+
+    def build(self, data):
+        self.is_ascii = microparse.detect_ascii(data)
+        if not self.is_ascii:
+            self.set_entries(static.scan(data, self.vendor, self.is_swap_endian))
+            return
+
+        # offsets of the binary data are translated back to spans of the input text
+        starts = []
+        ends = []
+        positions = []
+        position = 0
+        for start, end, value in microparse.ascii_fields(data):
+            starts.append(start)
+            ends.append(end)
+            positions.append(position)
+            position += len(value) // 2
+
+        entries = []
+        for e in static.scan(microparse.ascii2bin(data), self.vendor, self.is_swap_endian):
+            first = bisect.bisect_right(positions, e[0]) - 1
+            last = bisect.bisect_left(positions, e[0] + e[1]) - 1
+            entries.append((starts[first], ends[last] - starts[first]) + e[2 : ])
+        self.set_entries(entries)
+
+    def set_entries(self, entries):
+        self.entries = list(entries)
+        self.signatures = dict()
+
+        for e in self.entries:
+            self.signatures.setdefault(e[2], []).append(e)
+
+    def lookup(self, signature):
+        return self.signatures.get(signature, [])
+
+    def extract(self, f, entry):
+        f.seek(entry[0])
+        data = f.read(entry[1])
+        if self.is_ascii:
+            data = microparse.ascii2bin(data)
+
+        if self.vendor is amd:
+            # only the equivalence table entry of this signature is known
+            h = amd.static.header(self.is_swap_endian).unpack_from(data, 0)
+            return amd.microcode(data, {h[8] : [entry[2]]}, entry[1], self.is_swap_endian)
+        else:
+            return self.vendor.microcode(data, self.is_swap_endian)
+
+    # the sidecar is invalidated when the size or modification time of the input changes
+    def stamp(self, path):
+        st = os.stat(path)
+        return str(st.st_size) + "," + str(st.st_mtime_ns) + "," + self.vendor.__name__ + "," + str(int(self.is_swap_endian))
+
+    def load(self, path):
+        try:
+            with open(path + static.EXTENSION, "r") as f:
+                if f.readline().rstrip("\n") != self.stamp(path):
+                    return False
+
+                self.is_ascii = f.readline().rstrip("\n") == "ascii"
+                self.set_entries(tuple(int(v, 16) for v in line.split(",")) for line in f)
+        except (OSError, ValueError):
+            return False
+
+        return True
+
+    def save(self, path):
+        temporary = path + static.EXTENSION + "." + str(os.getpid()) + ".tmp"
+
+        with open(temporary, "w") as f:
+            f.write(self.stamp(path) + "\n")
+            f.write(("ascii" if self.is_ascii else "binary") + "\n")
+            for e in self.entries:
+                f.write(",".join(microparse.static.hex8(v) for v in e) + "\n")
+
+        os.replace(temporary, path + static.EXTENSION)
+
+def open_toc(path, vendor, swap_endian):
+    t = toc(vendor, swap_endian)
+
+    if not t.load(path):
+        with open(path, "rb") as f:
+            t.build(f.read())
+
+        try:
+            t.save(path)
+        except OSError as e:
+            microparse.static.tprint("Error: Cannot save table of contents: " + str(e))
+
+    return t
@@ -7,12 +7,20 @@ import struct
 # http://review.coreboot.org/gitweb?p=coreboot.git;a=blob;f=src/cpu/via/nano/update_ucode.c;hb=HEAD
 
 class static():
+    # typecodes for columnar storage of microcode header fields, None is an interned object
+    columns = (("magic", None), ("update_revision", "I"), ("day", "B"), ("month", "B"), ("year", "H"), ("signature", "I"), ("checksum", "I"), ("loader_revision", "I"), ("reserved1", "I"), ("payload_size", "I"), ("total_size", "I"), ("name", None), ("reserved2", "I"))
+
     def header(swap_endian):
         if swap_endian:
             return struct.Struct("<4sIBBHIIIIII8sI")
         else:
             return struct.Struct(">4sIBBHIIIIII8sI")
 
+    # find the next plausible header after a malformed one, using the magic string
+    def resync(data, offset, swap_endian):
+        offset = data.find(b"SARR", offset + 1)
+        return offset if offset != -1 else len(data)
+
 class microcode():
     def __init__(self, data, swap_endian):
         self.is_swap_endian = swap_endian
@@ -93,7 +101,7 @@ class microcode():
         microparse.static.fmt_string % ("Update Revision", microparse.static.hex8(self.update_revision)) + \
         microparse.static.fmt_string % ("Date", microparse.static.ymd2date(self.year, self.month, self.day)) + \
         microparse.static.fmt_string % ("Processor Signature", microparse.static.hex8(self.signature)) + \
-        str(microparse.signature(self.signature)) + \
+        str(microparse.signature.decode(self.signature)) + \
         microparse.static.fmt_string % ("Checksum", microparse.static.hex8(self.checksum)) + \
         microparse.static.fmt_string % ("Loader Revision", microparse.static.hex8(self.loader_revision)) + \
         microparse.static.fmt_string % ("Reserved 1", microparse.static.hex8(self.reserved1)) + \